@@ -3,27 +3,65 @@ import fitz
 from groq import Groq
 import sqlite3
 import json
-import base64
+import math
+import atexit
+import hashlib
+import inspect
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import pytesseract
 from pdf2image import convert_from_bytes
 from PIL import Image
 import shutil
+import tempfile
 
 tesseract_path = shutil.which("tesseract")
 
 if tesseract_path:
     pytesseract.pytesseract.tesseract_cmd = tesseract_path
 
+# The OCR fallback needs both Tesseract and Poppler (pdftoppm, used by pdf2image)
+OCR_AVAILABLE = bool(tesseract_path and shutil.which("pdftoppm"))
+
+# Pages are OCR'd in parallel, so keep each Tesseract process single-threaded
+# to avoid oversubscribing the CPU.
+os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+
 
 # --- MODEL CONSTANT ---
 # Current stable Groq model for fast, high-quality responses.
 GROQ_MODEL = "llama-3.1-8b-instant"
+# Upper bound on concurrent Groq requests issued by a single action, kept low
+# to stay within Groq's per-minute rate limits.
+GROQ_MAX_CONCURRENCY = 6
+# Groq free-tier request budget, shared by all concurrent workers, and how many
+# times the SDK retries 429/5xx responses (exponential backoff with jitter).
+GROQ_REQUESTS_PER_MINUTE = 30
+GROQ_MAX_RETRIES = 5
+# Characters of notes / paper text sent as context in a single prompt.
+LLM_CONTEXT_CHARS = 15000
+ANALOGY_CONTEXT_CHARS = 10000
+# Decode budget for a 10-question quiz. A full quiz with options and
+# explanations runs to about 2k tokens, and a JSON-mode answer cut off at the
+# cap is rejected outright, so this only guards against runaway output.
+QUIZ_MAX_TOKENS = 4096
 
 # --- CONFIGURABLE THRESHOLDS ---
 WEAK_TOPIC_ACCURACY_THRESHOLD = 0.80 # Below 80% is weak
 WEAK_TOPIC_MIN_ATTEMPTS = 3          # Used for 'Low Data' message, no longer blocks adaptive logic
 
+# --- PDF EXTRACTION SETTINGS ---
+OCR_MAX_WORKERS = min(8, os.cpu_count() or 1) # Parallel Tesseract processes for the OCR fallback
+OCR_RENDER_THREADS = min(4, os.cpu_count() or 1) # Parallel pdftoppm processes used to rasterize pages
+OCR_DPI = 200 # Render resolution for standard-size pages (pdf2image's default)
+OCR_MAX_LONG_EDGE_PX = 2400 # Oversized pages are rendered at a lower DPI so their long edge stays under this
+OCR_MIN_PAGE_TEXT_CHARS = 200 # Pages with at least this much text-layer text skip OCR
+OCR_PAGES_PER_CALL = 4 # Max pages packed into one Tesseract run once there are more pages than workers
+
 # --- PAGE CONFIG ---
 st.set_page_config(page_title="AI Study Companion", page_icon="🎓", layout="wide")
 
@@ -69,78 +107,133 @@ st.markdown("""
 """, unsafe_allow_html=True)
 
 # --- DATABASE LAYER (SQLite) ---
+# JSON columns are rewritten in full on every update, so store them without
+# the default ", " / ": " padding.
+JSON_SEPARATORS = (",", ":")
+# Every read and write goes through one locked connection, so WAL is not
+# about concurrency here: it appends commits to the log instead of rewriting
+# pages via a rollback journal, and with synchronous=NORMAL (still crash-safe
+# under WAL) a commit no longer waits on an fsync; the log is synced only at
+# checkpoints.
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-64000",
+)
+# raw_text (the full extracted document) is deliberately left out; the
+# dashboard never needs it, and nothing reads it back yet (it is stored on
+# project creation only).
+SELECT_PROJECT_SQL = """
+    SELECT name, level, notes, progress,
+           practice_data, analogy_data, exam_analysis
+    FROM projects WHERE name=?
+"""
+
 class StudyDB:
     def __init__(self, db_name='study_db.sqlite'):
         self.db_name = db_name
+        # One connection shared by every session and rerun. Streamlit runs
+        # sessions on separate threads, so access is serialized by a lock
+        # (re-entrant, since read-modify-write helpers nest calls).
+        self.conn = sqlite3.connect(db_name, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.lock = threading.RLock()
+        # Bumped (under the lock, after the commit) by every write to the
+        # projects table; the cached readers below are keyed on it.
+        self.projects_version = 0
+        for pragma in SQLITE_PRAGMAS:
+            self.conn.execute(pragma)
         self.init_db()
+        # Long-lived connection: refresh planner statistics on open and again
+        # when the process exits, as SQLite recommends.
+        self.conn.execute("PRAGMA optimize")
+        atexit.register(self.close)
 
-    def connect(self):
-        return sqlite3.connect(self.db_name)
+    def close(self):
+        with self.lock:
+            self.conn.execute("PRAGMA optimize")
+            self.conn.close()
 
     def init_db(self):
-        conn = self.connect()
-        c = conn.cursor()
-
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS projects (
-                name TEXT PRIMARY KEY,
-                level TEXT,
-                notes TEXT,
-                raw_text TEXT,
-                progress INTEGER DEFAULT 0,
-                practice_data TEXT,
-                analogy_data TEXT,
-                exam_analysis TEXT
-            )
-        ''')
-
-        for col_name in ['practice_data', 'analogy_data', 'exam_analysis']:
-            try:
-                c.execute(f"SELECT {col_name} FROM projects LIMIT 1")
-            except sqlite3.OperationalError:
-                c.execute(f"ALTER TABLE projects ADD COLUMN {col_name} TEXT DEFAULT '{{}}'")
-
-        conn.commit()
-        conn.close()
+        with self.lock, self.conn:
+            c = self.conn.cursor()
+
+            c.execute('''
+                CREATE TABLE IF NOT EXISTS projects (
+                    name TEXT PRIMARY KEY,
+                    level TEXT,
+                    notes TEXT,
+                    raw_text TEXT,
+                    progress INTEGER DEFAULT 0,
+                    practice_data TEXT,
+                    analogy_data TEXT,
+                    exam_analysis TEXT
+                )
+            ''')
+
+            for col_name in ['practice_data', 'analogy_data', 'exam_analysis']:
+                try:
+                    c.execute(f"SELECT {col_name} FROM projects LIMIT 1")
+                except sqlite3.OperationalError:
+                    c.execute(f"ALTER TABLE projects ADD COLUMN {col_name} TEXT DEFAULT '{{}}'")
+
+            # Content-addressed caches so re-uploads and level changes skip rework
+            c.execute('''
+                CREATE TABLE IF NOT EXISTS page_cache (
+                    hash TEXT PRIMARY KEY,
+                    transcription TEXT
+                )
+            ''')
+            c.execute('''
+                CREATE TABLE IF NOT EXISTS pdf_cache (
+                    hash TEXT PRIMARY KEY,
+                    text TEXT
+                )
+            ''')
+            c.execute('''
+                CREATE TABLE IF NOT EXISTS llm_cache (
+                    hash TEXT PRIMARY KEY,
+                    response TEXT
+                )
+            ''')
 
     def save_project(self, name, level, notes, raw_text,
                      practice_data="{}", analogy_data="{}", exam_analysis="{}"):
 
-        conn = self.connect()
-        c = conn.cursor()
-
-        c.execute('''
-            INSERT OR REPLACE INTO projects
-            (name, level, notes, raw_text, progress, practice_data, analogy_data, exam_analysis)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (name, level, notes, raw_text, 0, practice_data, analogy_data, exam_analysis))
-
-        conn.commit()
-        conn.close()
+        with self.lock:
+            with self.conn:
+                self.conn.execute('''
+                    INSERT OR REPLACE INTO projects
+                    (name, level, notes, raw_text, progress, practice_data, analogy_data, exam_analysis)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ''', (name, level, notes, raw_text, 0, practice_data, analogy_data, exam_analysis))
+            self.projects_version += 1
 
     # ---------- SAFE FIELD UPDATE ----------
-    def update_project_json_field(self, name, field_name, key, content):
+    def update_project_json_field(self, name, field_name, key, content, replaces=()):
 
         allowed_fields = ["practice_data", "analogy_data", "exam_analysis"]
         if field_name not in allowed_fields:
             return
 
-        project_data = self.get_project_details(name)
-        if not project_data:
-            return
+        # Held across the read and the write so concurrent sessions can't
+        # overwrite each other's keys.
+        with self.lock:
+            project_data = self.get_project_details(name)
+            if not project_data:
+                return
 
-        data_dict = json.loads(project_data.get(field_name) or "{}")
-        data_dict[key] = content
+            data_dict = json.loads(project_data.get(field_name) or "{}")
+            for old_key in replaces:
+                data_dict.pop(old_key, None)
+            data_dict[key] = content
 
-        conn = self.connect()
-        c = conn.cursor()
-
-        c.execute(f'''
-            UPDATE projects SET {field_name} = ? WHERE name = ?
-        ''', (json.dumps(data_dict), name))
-
-        conn.commit()
-        conn.close()
+            with self.conn:
+                self.conn.execute(f'''
+                    UPDATE projects SET {field_name} = ? WHERE name = ?
+                ''', (json.dumps(data_dict, separators=JSON_SEPARATORS), name))
+            self.projects_version += 1
 
     def update_practice_data(self, name, key, content):
         self.update_project_json_field(name, "practice_data", key, content)
@@ -148,105 +241,119 @@ class StudyDB:
     def update_analogy_data(self, name, key, content):
         self.update_project_json_field(name, "analogy_data", key, content)
 
-    def update_exam_analysis_data(self, name, key, content):
-        self.update_project_json_field(name, "exam_analysis", key, content)
+    def update_exam_analysis_data(self, name, key, content, replaces=()):
+        self.update_project_json_field(name, "exam_analysis", key, content, replaces)
 
     def load_all_projects(self):
-        conn = self.connect()
-        c = conn.cursor()
-        c.execute("SELECT name FROM projects")
-        projects = [row[0] for row in c.fetchall()]
-        conn.close()
-        return projects
+        with self.lock:
+            rows = self.conn.execute("SELECT name FROM projects").fetchall()
+        return [row[0] for row in rows]
 
     def get_project_details(self, name):
-        conn = self.connect()
-        c = conn.cursor()
-
-        c.execute("""
-            SELECT name, level, notes, raw_text, progress,
-                   practice_data, analogy_data, exam_analysis
-            FROM projects WHERE name=?
-        """, (name,))
-
-        row = c.fetchone()
-        conn.close()
-
-        if row:
-            return {
-                "name": row[0],
-                "level": row[1],
-                "notes": row[2],
-                "raw_text": row[3],
-                "progress": row[4],
-                "practice_data": row[5],
-                "analogy_data": row[6],
-                "exam_analysis": row[7]
-            }
+        with self.lock:
+            row = self.conn.execute(SELECT_PROJECT_SQL, (name,)).fetchone()
 
-        return None
+        return dict(row) if row else None
 
     # ---------- FIXED PROGRESS TRACKER ----------
     def update_progress_tracker(self, project_name, concept_scores):
 
-        project_data = self.get_project_details(project_name)
-        if not project_data:
-            return
+        with self.lock:
+            project_data = self.get_project_details(project_name)
+            if not project_data:
+                return
 
-        practice_dict = json.loads(project_data.get('practice_data') or "{}")
+            practice_dict = json.loads(project_data.get('practice_data') or "{}")
 
-        tracker_raw = practice_dict.get('progress_tracker') or {}
+            tracker_raw = practice_dict.get('progress_tracker') or {}
 
-        if isinstance(tracker_raw, str):
-            try:
-                tracker = json.loads(tracker_raw)
-            except:
-                tracker = {}
-        else:
-            tracker = tracker_raw
+            if isinstance(tracker_raw, str):
+                try:
+                    tracker = json.loads(tracker_raw)
+                except:
+                    tracker = {}
+            else:
+                tracker = tracker_raw
 
-        for concept, (correct, total) in concept_scores.items():
+            for concept, (correct, total) in concept_scores.items():
 
-            if concept not in tracker:
-                tracker[concept] = {"correct": 0, "total": 0}
+                if concept not in tracker:
+                    tracker[concept] = {"correct": 0, "total": 0}
 
-            tracker[concept]["correct"] += correct
-            tracker[concept]["total"] += total
+                tracker[concept]["correct"] += correct
+                tracker[concept]["total"] += total
 
-        practice_dict['progress_tracker'] = tracker
+            practice_dict['progress_tracker'] = tracker
 
-        conn = self.connect()
-        c = conn.cursor()
+            with self.conn:
+                self.conn.execute("""
+                    UPDATE projects SET practice_data = ? WHERE name = ?
+                """, (json.dumps(practice_dict, separators=JSON_SEPARATORS), project_name))
+            self.projects_version += 1
 
-        c.execute("""
-            UPDATE projects SET practice_data = ? WHERE name = ?
-        """, (json.dumps(practice_dict), project_name))
+    def reset_progress_tracker(self, project_name):
 
-        conn.commit()
-        conn.close()
+        with self.lock:
+            project_data = self.get_project_details(project_name)
+            if not project_data:
+                return
 
-    def reset_progress_tracker(self, project_name):
+            practice_dict = json.loads(project_data.get('practice_data') or "{}")
+            practice_dict['progress_tracker'] = {}
 
-        project_data = self.get_project_details(project_name)
-        if not project_data:
-            return
+            with self.conn:
+                self.conn.execute("""
+                    UPDATE projects SET practice_data = ? WHERE name = ?
+                """, (json.dumps(practice_dict, separators=JSON_SEPARATORS), project_name))
+            self.projects_version += 1
 
-        practice_dict = json.loads(project_data.get('practice_data') or "{}")
-        practice_dict['progress_tracker'] = {}
+    # ---------- EXTRACTION / NOTES CACHE ----------
+    def get_cached_page(self, page_hash):
+        with self.lock:
+            row = self.conn.execute("SELECT transcription FROM page_cache WHERE hash=?", (page_hash,)).fetchone()
+        return row[0] if row else None
 
-        conn = self.connect()
-        c = conn.cursor()
+    def cache_page(self, page_hash, transcription):
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO page_cache (hash, transcription) VALUES (?, ?)", (page_hash, transcription))
 
-        c.execute("""
-            UPDATE projects SET practice_data = ? WHERE name = ?
-        """, (json.dumps(practice_dict), project_name))
+    def get_cached_pdf(self, pdf_hash):
+        with self.lock:
+            row = self.conn.execute("SELECT text FROM pdf_cache WHERE hash=?", (pdf_hash,)).fetchone()
+        return row[0] if row else None
 
-        conn.commit()
-        conn.close()
+    def cache_pdf(self, pdf_hash, text):
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO pdf_cache (hash, text) VALUES (?, ?)", (pdf_hash, text))
 
-        
+    def get_cached_response(self, request_hash):
+        with self.lock:
+            row = self.conn.execute("SELECT response FROM llm_cache WHERE hash=?", (request_hash,)).fetchone()
+        return row[0] if row else None
+
+    def cache_response(self, request_hash, response):
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO llm_cache (hash, response) VALUES (?, ?)", (request_hash, response))
+
+
+@st.cache_resource(show_spinner=False)
+def get_study_db():
+    """Opens the database once per process instead of on every rerun."""
+    return StudyDB()
 
-db = StudyDB() # Initialize DB
+db = get_study_db() # Initialize DB
+
+# The dashboard re-reads the current project on every rerun (each widget
+# interaction), so reads are served from st.cache_data. Entries are keyed on
+# db.projects_version rather than cleared on write: a read that races a write
+# can only be stored under the old version, which no caller asks for again.
+@st.cache_data(show_spinner=False, max_entries=64)
+def load_project_names(version):
+    return db.load_all_projects()
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def load_project_details(name, version):
+    return db.get_project_details(name)
 
 # --- SESSION STATE ---
 if 'current_project' not in st.session_state:
@@ -270,6 +377,10 @@ if 'exam_analysis_pdf_content' not in st.session_state:
     st.session_state.exam_analysis_pdf_content = ""
 if 'last_uploaded_exam_pdf_id' not in st.session_state:
     st.session_state.last_uploaded_exam_pdf_id = None
+if 'new_project_raw_text' not in st.session_state:
+    st.session_state.new_project_raw_text = ""
+if 'last_uploaded_project_pdf_id' not in st.session_state:
+    st.session_state.last_uploaded_project_pdf_id = None
 if 'weak_topics' not in st.session_state: 
     st.session_state.weak_topics = []
 if 'focus_quiz_active' not in st.session_state: 
@@ -277,43 +388,195 @@ if 'focus_quiz_active' not in st.session_state:
 
 
 # --- HELPER FUNCTION FOR ROBUST JSON PARSING ---
+JSON_DECODER = json.JSONDecoder()
+JSON_FENCE_RE = re.compile(r"^\s*```(?:json)?\s*|\s*```\s*$")
+
 def safe_json_parse(json_str):
     """Safely extracts and parses JSON content from a string, handling LLM noise."""
     if not json_str:
         return None
-    
-    # Attempt to find the clean JSON block (removes '```json' and leading/trailing noise)
+
+    # JSON-mode responses are already clean, so try them as-is first
+    try:
+        return json.loads(json_str)
+    except json.JSONDecodeError:
+        pass
+
+    # Remove markdown code fence markers if they exist
+    clean_json_str = JSON_FENCE_RE.sub("", json_str)
     try:
-        start_index = json_str.find('{')
-        end_index = json_str.rfind('}')
-        
-        if start_index == -1 or end_index == -1:
-            # If no curly braces found, try to parse the whole thing anyway
-            return json.loads(json_str.strip())
-
-        clean_json_str = json_str[start_index:end_index + 1]
-        # Remove markdown code fence markers if they exist
-        if clean_json_str.startswith('```json'):
-            clean_json_str = clean_json_str[len('```json'):].strip()
-        if clean_json_str.endswith('```'):
-            clean_json_str = clean_json_str[:-len('```')].strip()
-
-        # Final check for valid JSON (empty check is inside the try block)
-        if not clean_json_str:
-            return None
-            
         return json.loads(clean_json_str)
-    
-    except json.JSONDecodeError as e:
-        # print(f"JSON Decode Error: {e}")
+    except json.JSONDecodeError:
+        pass
+
+    # Last resort: decode the first complete {...} object and ignore any
+    # leading/trailing prose (even prose that itself contains braces)
+    start_index = clean_json_str.find('{')
+    if start_index == -1:
         return None
-    except Exception as e:
-        # print(f"Unexpected JSON cleaning error: {e}")
+
+    try:
+        return JSON_DECODER.raw_decode(clean_json_str, start_index)[0]
+    except json.JSONDecodeError:
         return None
 
 
+# --- PROGRESS REPORTING ---
+# Each progress update is a websocket message to the browser, so fast loops
+# redraw at most this often (the final update is always shown).
+PROGRESS_UPDATE_INTERVAL = 0.25 # seconds
+
+class ThrottledProgress:
+    """A caption plus progress bar whose redraws are rate-limited."""
+
+    def __init__(self):
+        self.status = st.empty()
+        self.bar = st.progress(0)
+        self.last_update = 0.0
+
+    def update(self, fraction, message):
+        now = time.monotonic()
+        if fraction < 1 and now - self.last_update < PROGRESS_UPDATE_INTERVAL:
+            return
+        self.last_update = now
+        self.bar.progress(fraction)
+        self.status.caption(message)
+
+    def empty(self):
+        self.status.empty()
+        self.bar.empty()
+
+
 # --- LLM Functions ---
 
+@st.cache_resource(show_spinner=False)
+def get_groq_client(api_key):
+    """
+    Returns one Groq client per API key, shared across reruns and sessions so its
+    underlying httpx connection pool (and TLS sessions) stay warm.
+    """
+    return Groq(api_key=api_key, max_retries=GROQ_MAX_RETRIES)
+
+class GroqRateLimiter:
+    """
+    Thread-safe token bucket that keeps concurrent Groq workers under a
+    requests-per-minute budget while still allowing a short burst.
+    """
+    def __init__(self, requests_per_minute, burst):
+        self.rate = requests_per_minute / 60.0
+        self.capacity = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+@st.cache_resource(show_spinner=False)
+def get_groq_rate_limiter(api_key):
+    """
+    One limiter per API key, like get_groq_client, so the budget is shared across
+    reruns and sessions using the same key without throttling other keys.
+    """
+    return GroqRateLimiter(GROQ_REQUESTS_PER_MINUTE, burst=GROQ_MAX_CONCURRENCY)
+
+def llm_cache_key(messages, temperature, model=GROQ_MODEL, **params):
+    """SHA-256 of everything that determines a completion, used as the llm_cache key."""
+    request = [model, temperature, messages] + ([params] if params else [])
+    return hashlib.sha256(json.dumps(request, separators=JSON_SEPARATORS, sort_keys=True).encode("utf-8")).hexdigest()
+
+def cached_chat_completion(client, messages, temperature, is_valid=None, **params):
+    """
+    Exact-match cached chat completion. Identical requests are answered from
+    llm_cache; only successful responses (that pass `is_valid`, if given)
+    are stored. Extra `params` are passed to Groq and are part of the key.
+    """
+    request_hash = llm_cache_key(messages, temperature, **params)
+    response = db.get_cached_response(request_hash)
+    if response is None:
+        completion = client.chat.completions.create(model=GROQ_MODEL, messages=messages, temperature=temperature, **params)
+        response = completion.choices[0].message.content
+        if is_valid is None or is_valid(response):
+            db.cache_response(request_hash, response)
+    return response
+
+def context_head(text, limit=LLM_CONTEXT_CHARS):
+    """
+    Leading slice of notes or paper text that fits in one prompt's context.
+    Cuts at the last paragraph break (or, failing that, whitespace) before the
+    limit so the model never gets a half-finished word or section.
+    """
+    if len(text) <= limit:
+        return text
+    head = text[:limit]
+    cut = head.rfind("\n\n")
+    if cut < limit * 0.8:
+        cut = max(head.rfind("\n"), head.rfind(" "))
+    return head[:cut] if cut > 0 else head
+
+MARKDOWN_SECTION_RE = re.compile(r"\n(?=#{1,6}\s)")
+CONTEXT_TERM_RE = re.compile(r"[a-z0-9]{3,}")
+# Filler words in topic names ("Sorting and Searching") that would otherwise
+# match nearly every section
+CONTEXT_STOPWORDS = {
+    "and", "the", "for", "with", "from", "into", "onto", "its", "are", "was",
+    "not", "but", "how", "what", "why", "when", "who", "which", "that", "this",
+    "their", "vs", "via", "per", "all", "any", "use", "using", "part", "intro",
+    "introduction", "basics", "overview",
+}
+
+def topic_context(text, topics, limit=LLM_CONTEXT_CHARS):
+    """
+    Context for a topic-focused prompt: the Markdown sections of `text` that
+    mention `topics` most, kept in document order, instead of just the head.
+    Lexical scoring (exact topic phrase hits weigh more than single words), so
+    weak topics covered late in long notes still reach the model. Falls back
+    to context_head when nothing matches.
+    """
+    if len(text) <= limit:
+        return text
+
+    phrases = [t.strip().lower() for t in topics if t.strip()]
+    terms = {w for phrase in phrases for w in CONTEXT_TERM_RE.findall(phrase)} - CONTEXT_STOPWORDS
+    sections = MARKDOWN_SECTION_RE.split(text)
+
+    scored = []
+    for i, section in enumerate(sections):
+        lowered = section.lower()
+        score = 3 * sum(phrase in lowered for phrase in phrases) + len(terms.intersection(CONTEXT_TERM_RE.findall(lowered)))
+        if score:
+            scored.append((-score, i))
+    if not scored:
+        return context_head(text, limit)
+
+    chosen, skipped, size = {}, [], 0
+    for _, i in sorted(scored):
+        section_len = len(sections[i]) + 1
+        if size + section_len <= limit:
+            chosen[i] = sections[i]
+            size += section_len
+        else:
+            skipped.append(i)
+    # Matching sections too long to fit whole still get the leftover budget,
+    # best match first, so a long section on a weak topic isn't dropped outright
+    for i in skipped:
+        remaining = limit - size - 1
+        if remaining < 200:
+            break
+        head = context_head(sections[i], remaining)
+        chosen[i] = head
+        size += len(head) + 1
+    return "\n".join(chosen[i] for i in sorted(chosen))
+
 def get_system_prompt(level):
     if level == "Basic":
         return """Act as a Tutor. GOAL: Pass the exam. Focus on definitions, brevity, and outlines. Output strictly Markdown. If you see text describing a diagram, use an 
@@ -334,17 +597,27 @@ def get_system_prompt(level):
     else: # Advanced
         return """Act as a Subject Matter Expert. GOAL: Mastery. Explain nuances, real-world context, and deep connections. Output strictly Markdown. Insert  tags for every concept that would be better understood with a visual aid, using a detailed description for X."""
 
-def _attempt_quiz_generation(system_prompt, notes_truncated, client):
+def _attempt_quiz_generation(system_prompt, notes_truncated, client, focus_topics=None):
     """Internal helper to call the Groq API with given prompt and notes."""
+    user_content = f"Generate 10 questions in strict JSON format based on these notes: {notes_truncated}"
+    if focus_topics:
+        topics_list_str = ", ".join(focus_topics)
+        user_content += (
+            f"\n\nWEAK TOPICS: {topics_list_str}\n"
+            f'Use "quiz_title": "Adaptive Focus Drill (Weak Topics: {topics_list_str})" and set every "primary_concept" '
+            f'to one of the WEAK TOPICS exactly, e.g. "primary_concept": "{focus_topics[0]}".'
+        )
     try:
         completion = client.chat.completions.create(
             model=GROQ_MODEL, 
             messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": f"Generate 10 questions in strict JSON format based on these notes: {notes_truncated}"}
+                # cleandoc strips the source indentation, which is otherwise sent as tokens
+                {"role": "system", "content": inspect.cleandoc(system_prompt)},
+                {"role": "user", "content": user_content}
             ],
             response_format={"type": "json_object"}, # Enforce JSON output
-            temperature=0.8 # Use 0.8 for a good mix of question types
+            temperature=0.8, # Use 0.8 for a good mix of question types
+            max_tokens=QUIZ_MAX_TOKENS
         )
         return completion.choices[0].message.content
     except Exception as e:
@@ -371,23 +644,9 @@ def generate_interactive_drills(notes, client):
     The entire output MUST be a single JSON object. No other text, markdown, or commentary is allowed outside the JSON structure.
 
     JSON Format MUST be:
-    {
-      "quiz_title": "Interactive Practice Drill (General)",
-      "questions": [
-        {
-          "id": 1,
-          "type": "MCQ",
-          "question_text": "...",
-          "options": ["A: ...", "B: ...", "C: ...", "D: ..."],
-          "correct_answer": "B", 
-          "primary_concept": "Search Algorithms", 
-          "detailed_explanation": "A* search is an informed search algorithm..."
-        },
-        {...}
-      ]
-    }
+    {"quiz_title": "Interactive Practice Drill (General)", "questions": [{"id": 1, "type": "MCQ", "question_text": "...", "options": ["A: ...", "B: ...", "C: ...", "D: ..."], "correct_answer": "B", "primary_concept": "Search Algorithms", "detailed_explanation": "..."}, ...]}
     """
-    notes_truncated = notes[:15000]
+    notes_truncated = context_head(notes)
 
     with st.spinner("Generating general practice drills..."):
         return _attempt_quiz_generation(system_prompt, notes_truncated, client)
@@ -402,108 +661,170 @@ def generate_focused_drills(notes, weak_topics, client):
     
     # -------------------------------------------------------------------------
     # --- HARDENED SYSTEM PROMPT FOR FOCUS QUIZ ---
-    system_prompt = f"""You are an ADAPTIVE quiz master for technical subjects. Based on the notes, generate a quiz with 10 questions total.
+    # The prompt is fixed; the weak topics (and the title / primary_concept
+    # values built from them) are sent after the notes in the user message so
+    # the shared prefix stays cacheable across focus drills.
+    system_prompt = """You are an ADAPTIVE quiz master for technical subjects. Based on the notes, generate a quiz with 10 questions total.
     
-    ***STRICT INSTRUCTION:*** The 10 questions MUST ONLY test the following concepts. You must use these terms verbatim:
-    WEAK TOPICS: {topics_list_str}
+    ***STRICT INSTRUCTION:*** The 10 questions MUST ONLY test the WEAK TOPICS listed at the end of the user message. You must use these terms verbatim.
     
     The quiz must consist of a mix of Multiple Choice Questions (MCQs) and True or False Questions (T/F). Be concise in your questions and explanations.
 
     For every question, you MUST provide a 'primary_concept' and a 'detailed_explanation'.
-    - The 'primary_concept' MUST be **one exact match** from the list: {topics_list_str}. **DO NOT ALTER OR ADD TO THESE TERMS.** This is crucial for clean score tracking.
+    - The 'primary_concept' MUST be **one exact match** from the WEAK TOPICS list. **DO NOT ALTER OR ADD TO THESE TERMS.** This is crucial for clean score tracking.
     - The 'detailed_explanation' is the brief feedback (1-2 sentence) for the user.
 
     The entire output MUST be a single JSON object. No other text, markdown, or commentary is allowed outside the JSON structure.
 
     JSON Format MUST be:
-    {{
-      "quiz_title": "Adaptive Focus Drill (Weak Topics: {topics_list_str})",
-      "questions": [
-        {{
-          "id": 1,
-          "type": "MCQ",
-          "question_text": "...",
-          "options": ["A: ...", "B: ...", "C: ...", "D: ..."],
-          "correct_answer": "B", 
-          "primary_concept": "{weak_topics[0] if weak_topics else 'Concept'}", 
-          "detailed_explanation": "..."
-        }},
-        // ... 9 more questions
-      ]
-    }}
+    {"quiz_title": "...", "questions": [{"id": 1, "type": "MCQ", "question_text": "...", "options": ["A: ...", "B: ...", "C: ...", "D: ..."], "correct_answer": "B", "primary_concept": "...", "detailed_explanation": "..."}, ...]}
+    The exact quiz_title and primary_concept values to use are given with the WEAK TOPICS.
     """
     # -------------------------------------------------------------------------
     
-    notes_truncated = notes[:15000]
+    # Pick the parts of the notes that cover the weak topics, wherever they are
+    notes_truncated = topic_context(notes, weak_topics)
 
     with st.spinner(f"Generating FOCUS drills on: {topics_list_str}..."):
         # The internal helper _attempt_quiz_generation handles the API call
-        return _attempt_quiz_generation(system_prompt, notes_truncated, client)
+        return _attempt_quiz_generation(system_prompt, notes_truncated, client, focus_topics=weak_topics)
+
 
+NOTES_TEMPERATURE = 0.3
+
+def notes_batch_messages(prompt):
+    return [{"role": "user", "content": prompt}]
+
+def _synthesize_notes_batch(prompt, client, rate_limiter, stream=False):
+    """
+    Runs a single study-notes batch through Groq. Safe to call from a worker thread.
+    With stream=True, returns a generator of text deltas instead of the full text.
+    """
+    rate_limiter.acquire()
+    completion = client.chat.completions.create(model=GROQ_MODEL, messages=notes_batch_messages(prompt), temperature=NOTES_TEMPERATURE, stream=stream)
+    if stream:
+        return (chunk.choices[0].delta.content or "" for chunk in completion)
+    return completion.choices[0].message.content
+
+PAGE_BREAK_RE = re.compile(r"\n?--- PAGE_BREAK ---\n?")
+
+def iter_page_batches(raw_text, batch_size=15):
+    """Yields the joined text of each run of `batch_size` non-trivial pages."""
+    batch = []
+    for page in PAGE_BREAK_RE.split(raw_text):
+        if len(page.strip()) <= 50:
+            continue
+        batch.append(page)
+        if len(batch) == batch_size:
+            yield "\n".join(batch)
+            batch = []
+    if batch:
+        yield "\n".join(batch)
 
 def generate_study_notes(raw_text, level, client):
-    pages = raw_text.split("--- PAGE_BREAK ---")
-    pages = [p for p in pages if len(p.strip()) > 50]
-    batch_size = 15 
-    batches = [pages[i:i + batch_size] for i in range(0, len(pages), batch_size)]
-    final_notes = f"# 📘 {level} Study Guide\n\n"
-    status_text = st.empty()
-    bar = st.progress(0)
-    for i, batch in enumerate(batches):
-        bar.progress((i + 1) / len(batches))
-        status_text.caption(f"🧠 Synthesizing Batch {i+1}/{len(batches)}...")
-        prompt = f"""{get_system_prompt(level)}\nCONTENT: {"\n".join(batch)}\nOutput strictly Markdown."""
+    system_prompt = get_system_prompt(level)
+    prompts = [
+        f"""{system_prompt}\nCONTENT: {batch_content}\nOutput strictly Markdown."""
+        for batch_content in iter_page_batches(raw_text)
+    ]
+
+    # Batches already synthesized for this exact prompt (same content + level)
+    # are served from the LLM response cache.
+    prompt_hashes = [llm_cache_key(notes_batch_messages(prompt), NOTES_TEMPERATURE) for prompt in prompts]
+    batch_notes = [db.get_cached_response(h) for h in prompt_hashes]
+    pending = [i for i, notes in enumerate(batch_notes) if notes is None]
+
+    rate_limiter = get_groq_rate_limiter(client.api_key)
+    progress = ThrottledProgress()
+    preview = st.empty()
+    done = 0
+
+    def record_batch(i, get_notes):
+        nonlocal done
         try:
-            completion = client.chat.completions.create(model=GROQ_MODEL, messages=[{"role": "user", "content": prompt}], temperature=0.3)
-            final_notes += completion.choices[0].message.content + "\n\n---\n\n"
+            batch_notes[i] = get_notes()
+            db.cache_response(prompt_hashes[i], batch_notes[i])
         except Exception as e:
-            final_notes += f"(Error during generation: {e})\n\n---\n\n"
-    status_text.empty()
-    bar.empty()
-    return final_notes
+            batch_notes[i] = f"(Error during generation: {e})"
+        done += 1
+        progress.update(done / len(pending), f"🧠 Synthesized Batch {done}/{len(pending)}...")
+
+    # Batches are independent, so they are sent to Groq concurrently and
+    # reassembled in their original order. The first pending batch is streamed
+    # into the page so text shows up immediately while the rest run in the
+    # background. UI updates stay on this thread.
+    with ThreadPoolExecutor(max_workers=max(1, min(len(pending) - 1, GROQ_MAX_CONCURRENCY))) as executor:
+        futures = {executor.submit(_synthesize_notes_batch, prompts[i], client, rate_limiter): i for i in pending[1:]}
+        if pending:
+            progress.status.caption(f"🧠 Synthesizing {len(pending)} Batch(es)...")
+            record_batch(pending[0], lambda: preview.write_stream(_synthesize_notes_batch(prompts[pending[0]], client, rate_limiter, stream=True)))
+        for future in as_completed(futures):
+            record_batch(futures[future], future.result)
+    progress.empty()
+    preview.empty()
+    return f"# 📘 {level} Study Guide\n\n" + "".join(notes + "\n\n---\n\n" for notes in batch_notes)
 
 def generate_analogies(notes, client):
     system_prompt = """You are a creative tutor specializing in making complex scientific (Physics, Chemistry, Biology) and technical topics instantly relatable. Your task is to identify 5 key concepts from the provided study notes. For each concept, provide a detailed, clear, real-life analogy. Format the output strictly as a list of concepts and their analogies in clear Markdown. Use the format: '**[Concept Title]**' followed by 'Analogy: [The detailed analogy]'."""
-    notes_truncated = notes[:10000]
+    notes_truncated = context_head(notes, ANALOGY_CONTEXT_CHARS)
+    # Streamed into a temporary preview so the analogies appear as they are
+    # written; callers still get the full text back to save.
+    preview = st.empty()
     try:
         with st.spinner("Generating core concepts and analogies..."):
-            completion = client.chat.completions.create(model=GROQ_MODEL, messages=[{"role": "system", "content": system_prompt}, {"role": "user", "content": f"Generate 5 analogies based on the following notes: {notes_truncated}"}], temperature=0.7)
-        return completion.choices[0].message.content
+            completion = client.chat.completions.create(model=GROQ_MODEL, messages=[{"role": "system", "content": system_prompt}, {"role": "user", "content": f"Generate 5 analogies based on the following notes: {notes_truncated}"}], temperature=0.7, stream=True)
+        return preview.write_stream(chunk.choices[0].delta.content or "" for chunk in completion)
     except Exception as e:
         return f"Error generating analogies: {e}"
+    finally:
+        preview.empty()
 
 def generate_specific_analogy(topic, client):
-    system_prompt = f"""You are a creative tutor. Your task is to provide a single, detailed, and clear real-life analogy for the concept: '{topic}'. The analogy must be highly relatable. Output only the analogy in clear Markdown, starting with the header '### Analogy for {topic}'."""
+    system_prompt = """You are a creative tutor. Your task is to provide a single, detailed, and clear real-life analogy for the concept named by the user. The analogy must be highly relatable. Output only the analogy in clear Markdown, without a title or header."""
     try:
         with st.spinner(f"Generating analogy for '{topic}'..."):
-            completion = client.chat.completions.create(model=GROQ_MODEL, messages=[{"role": "system", "content": system_prompt}, {"role": "user", "content": f"Generate a detailed real-life analogy for the topic: {topic}"}], temperature=0.6)
-        return completion.choices[0].message.content
+            # The header is added here rather than requested from the model, so the
+            # prompt stays fixed without the model echoing a placeholder
+            return f"### Analogy for {topic}\n\n" + cached_chat_completion(client, [{"role": "system", "content": system_prompt}, {"role": "user", "content": f"Generate a detailed real-life analogy for the topic: {topic}"}], temperature=0.6)
     except Exception as e:
         return f"Error generating analogy: {e}"
 
+def format_qna_markdown(questions):
+    """Renders [{"question", "answer", "topic"}, ...] as the Q:/A: Markdown shown in the Theory tab."""
+    blocks = []
+    valid = [item for item in questions if isinstance(item, dict) and item.get("question")]
+    for n, item in enumerate(valid, start=1):
+        topic = f" _({item['topic']})_" if item.get("topic") else ""
+        blocks.append(f"**Q{n}: {item['question']}**{topic}\n\n**A:** {item.get('answer', '')}")
+    return "\n\n---\n\n".join(blocks)
+
 def generate_qna(notes, q_type, marks, client):
     q_type_text = ""
     if q_type == "short":
-        q_type_text = "5 questions requiring concise, short-answer responses (approx. 50-75 words each). Format each as Q: followed by A:."
+        q_type_text = "5 questions requiring concise, short-answer responses (approx. 50-75 words each)."
     elif q_type == "long":
-        q_type_text = "3 questions requiring detailed, long-answer responses (approx. 150-250 words each). Format each as Q: followed by A:."
+        q_type_text = "3 questions requiring detailed, long-answer responses (approx. 150-250 words each)."
     elif q_type == "custom":
-        q_type_text = f"5 questions suitable for an exam where each question is worth approximately {marks} marks. The length and detail should match typical answers for that mark value. Format each as Q: followed by A:."
-    system_prompt = f"You are a study guide generator. Your task is to analyze the provided study notes and generate {q_type_text} The output must be pure markdown."
-    notes_truncated = notes[:15000]
+        q_type_text = f"5 questions suitable for an exam where each question is worth approximately {marks} marks. The length and detail should match typical answers for that mark value."
+    system_prompt = (
+        "You are a study guide generator. Your task is to analyze the provided study notes and generate the questions the user asks for. "
+        'Return a single JSON object of the form {"questions": [{"question": "...", "answer": "...", "topic": "..."}]}. '
+        "Answers may use Markdown."
+    )
+    notes_truncated = context_head(notes)
     try:
         with st.spinner(f"Generating {q_type} Q&A from notes..."):
-            completion = client.chat.completions.create(model=GROQ_MODEL, messages=[{"role": "system", "content": system_prompt}, {"role": "user", "content": f"Generate Q&A based on the following notes: {notes_truncated}"}], temperature=0.5)
-        return completion.choices[0].message.content
+            completion = client.chat.completions.create(model=GROQ_MODEL, messages=[{"role": "system", "content": system_prompt}, {"role": "user", "content": f"Study notes: {notes_truncated}\n\nGenerate {q_type_text}"}], response_format={"type": "json_object"}, temperature=0.5)
+        content = completion.choices[0].message.content
     except Exception as e:
         return f"Error generating Q&A: {e}"
+
+    result = safe_json_parse(content)
+    if isinstance(result, dict) and isinstance(result.get("questions"), list):
+        return format_qna_markdown(result["questions"]) or content
+    return content
         
-def analyze_past_papers(paper_content, client):
-    """
-    Analyzes past paper content to find key topics and repeated questions.
-    This function is explicitly independent of the main study notes.
-    """
-    system_prompt = """You are an expert exam analyst. Your primary task is to **analyze the pattern of questions** extracted from the past exam paper content. You MUST NOT generate answers to the questions.
+PAST_PAPER_ANALYSIS_PROMPT = """You are an expert exam analyst. Your primary task is to **analyze the pattern of questions** extracted from the past exam paper content. You MUST NOT generate answers to the questions.
 
     Analyze the questions and the mark distribution to determine the most important topics and question patterns.
 
@@ -513,25 +834,42 @@ def analyze_past_papers(paper_content, client):
     2.  **Repeated Question Themes:** Identify questions that, while phrased differently, are essentially testing the same core information (e.g., "Explain X" and "What are the characteristics of X"). List 3-5 distinct themes.
     3.  **High-Level Strategy:** Provide a 3-point strategy for studying based *specifically* on the trends observed in the question content.
 
-    Exam Question Content (The document you must analyze): {paper_content}
+    The exam question content to analyze is provided in the user message.
+    """
+
+def past_paper_user_message(paper_content, task):
+    """Exam content goes in the user turn so the fixed instructions form a stable prompt prefix."""
+    return f"Exam Question Content (The document you must analyze): {paper_content}\n\n{task}"
+
+# Prefix of the report analyze_past_papers returns when the call fails; such
+# reports are never saved or reused.
+EXAM_ANALYSIS_ERROR_PREFIX = "Error performing exam analysis"
+# Exam analyses are keyed on a sha256 of the paper text; anything else is a
+# legacy analysis_{hash()} key from before keys were stable across restarts.
+EXAM_ANALYSIS_KEY_RE = re.compile(r"analysis_[0-9a-f]{64}")
+
+def analyze_past_papers(paper_content, client):
+    """
+    Analyzes past paper content to find key topics and repeated questions.
+    This function is explicitly independent of the main study notes.
     """
     
     # Truncate content if necessary for the LLM context limit
-    content_truncated = paper_content[:15000]
+    content_truncated = context_head(paper_content)
 
     try:
         with st.spinner("Analyzing past papers for trends and important topics..."):
             completion = client.chat.completions.create(
                 model=GROQ_MODEL, 
                 messages=[
-                    {"role": "system", "content": system_prompt.format(paper_content=content_truncated)},
-                    {"role": "user", "content": "Perform the exam analysis and output the results as described (Analysis only, no answers)."}
+                    {"role": "system", "content": PAST_PAPER_ANALYSIS_PROMPT},
+                    {"role": "user", "content": past_paper_user_message(content_truncated, "Perform the exam analysis and output the results as described (Analysis only, no answers).")}
                 ],
                 temperature=0.4
             )
         return completion.choices[0].message.content
     except Exception as e:
-        return f"Error performing exam analysis: {e}"
+        return f"{EXAM_ANALYSIS_ERROR_PREFIX}: {e}"
 
 
 # --- UI INTERACTIVE LOGIC ---
@@ -762,7 +1100,14 @@ def display_and_grade_quiz(project_name, quiz_json_str):
     return
 
 # --- UTILITY FUNCTIONS ---
-import re
+
+# Exam-paper patterns, compiled once at import
+WHITESPACE_RE = re.compile(r'\s+')
+QUESTION_NUMBER_RE = re.compile(r'Q\d+')
+SECTION_RE = re.compile(r'Section\s+[A-Z]')
+QUESTION_BLOCK_RE = re.compile(r'(Q\d+.*?)(?=Q\d+|$)')
+MARKS_RE = re.compile(r'(\d+)\s*[Mm]arks')
+TOPIC_PHRASE_RE = re.compile(r'\b[A-Z][a-zA-Z\s]{3,}\b')
 
 def clean_ocr_text(text):
 
@@ -777,19 +1122,19 @@ def clean_ocr_text(text):
     for wrong, correct in replacements.items():
         text = text.replace(wrong, correct)
 
-    text = re.sub(r'\s+', ' ', text)
-    text = re.sub(r'(Q\d+)', r'\n\1', text)
-    text = re.sub(r'(Section\s+[A-Z])', r'\n\1', text)
+    text = WHITESPACE_RE.sub(' ', text)
+    text = QUESTION_NUMBER_RE.sub(r'\n\g<0>', text)
+    text = SECTION_RE.sub(r'\n\g<0>', text)
 
     return text
 
 def detect_exam_structure(text):
 
-    questions = re.findall(r'(Q\d+.*?)(?=Q\d+|$)', text)
+    questions = QUESTION_BLOCK_RE.findall(text)
 
-    marks = re.findall(r'(\d+)\s*[Mm]arks', text)
+    marks = MARKS_RE.findall(text)
 
-    sections = re.findall(r'Section\s+[A-Z]', text)
+    sections = SECTION_RE.findall(text)
 
     structure = {
         "sections": list(set(sections)),
@@ -800,10 +1145,8 @@ def detect_exam_structure(text):
     return structure
 def analyze_topic_frequency(text):
 
-    import re
-
     # Extract candidate topics (simple heuristic using capitalized words and phrases)
-    topics = re.findall(r'\b[A-Z][a-zA-Z\s]{3,}\b', text)
+    topics = TOPIC_PHRASE_RE.findall(text)
 
     topic_freq = {}
 
@@ -820,16 +1163,14 @@ def analyze_topic_frequency(text):
     return sorted_topics[:10]  # Top 10 repeated topics
 def analyze_marks_weightage(text):
 
-    import re
-
-    question_blocks = re.findall(r'(Q\d+.*?)(?=Q\d+|$)', text)
+    question_blocks = QUESTION_BLOCK_RE.findall(text)
 
     weightage_map = {}
 
     for block in question_blocks:
 
-        marks = re.findall(r'(\d+)\s*[Mm]arks', block)
-        topics = re.findall(r'\b[A-Z][a-zA-Z\s]{3,}\b', block)
+        marks = MARKS_RE.findall(block)
+        topics = TOPIC_PHRASE_RE.findall(block)
 
         if marks:
             mark_value = int(marks[0])
@@ -872,7 +1213,60 @@ Output only questions in markdown bullet format.
 
     return completion.choices[0].message.content
 
+def analyze_past_papers_with_predictions(paper_content, topics, client):
+    """
+    Runs the past-paper analysis and the predicted-question generation as one
+    Groq call, since both work from the same exam content.
+    Falls back to the two separate calls if the combined response can't be parsed.
+    Returns (analysis_markdown, predicted_questions_markdown).
+    """
+    topic_list = ", ".join([t[0] for t in topics])
+    content_truncated = context_head(paper_content)
+
+    system_prompt = PAST_PAPER_ANALYSIS_PROMPT + """
+    Additionally, based on historical exam trends, generate 5 highly probable exam questions from the frequently occurring topics listed in the user message.
+
+    Return a single JSON object with exactly these two keys and nothing else:
+    {"analysis": "<the analysis above, in Markdown>", "predicted_questions": "<the 5 questions as a Markdown bullet list>"}
+    """
+
+    def parse_result(content):
+        result = safe_json_parse(content)
+        if isinstance(result, dict):
+            analysis, predicted = result.get("analysis"), result.get("predicted_questions")
+            if isinstance(analysis, str) and analysis.strip() and isinstance(predicted, str) and predicted.strip():
+                return analysis, predicted
+        return None
+
+    # The same paper (e.g. shared across projects) is answered from the LLM cache
+    try:
+        with st.spinner("Analyzing past papers for trends and important topics..."):
+            content = cached_chat_completion(
+                client,
+                [
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": past_paper_user_message(content_truncated, f"Frequently occurring topics: {topic_list}\n\nPerform the exam analysis and predict questions, returning the JSON object described (Analysis only, no answers).")}
+                ],
+                temperature=0.4,
+                is_valid=lambda content: parse_result(content) is not None,
+                response_format={"type": "json_object"}
+            )
+        result = parse_result(content)
+    except Exception:
+        result = None
+
+    if result:
+        return result
+
+    # Fallback: independent calls
+    return analyze_past_papers(paper_content, client), generate_predicted_questions(topics, client)
+
+@st.cache_data(show_spinner=False)
 def aggregate_exam_trends(exam_analysis_data):
+    """
+    Topic probabilities across all saved analyses. Runs on every dashboard
+    rerun, so results are memoized per set of analyses.
+    """
 
     combined_text = " ".join(exam_analysis_data.values())
 
@@ -907,59 +1301,209 @@ Marks Distribution: {structure['marks_distribution']}
 
     return enhanced_prompt
 
-def extract_pdf_content(uploaded_file):
+def _ocr_dpi(page_rect):
+    """Picks a render DPI so the page's long edge stays within OCR_MAX_LONG_EDGE_PX."""
+    long_edge_pt = max(page_rect.width, page_rect.height) or 1
+    return min(OCR_DPI, int(OCR_MAX_LONG_EDGE_PX * 72 / long_edge_pt))
 
-    uploaded_file.seek(0)
-    file_bytes = uploaded_file.read()
+def _render_pages(pdf_bytes, page_dpis):
+    """
+    Rasterizes only the requested pages for OCR and returns {page_index: image}.
+    `page_dpis` maps 0-based page indices to their render DPI; consecutive
+    pages sharing a DPI are rendered in one pdf2image call each.
+    """
+    images = {}
+    runs = []
+    for i, dpi in page_dpis.items():
+        if runs and i == runs[-1][-1] + 1 and dpi == page_dpis[runs[-1][-1]]:
+            runs[-1].append(i)
+        else:
+            runs.append([i])
+
+    for run in runs:
+        # pdf2image splits the page range across several pdftoppm processes,
+        # so rasterization is not bound to a single core. Pages are rendered in
+        # grayscale since Tesseract binarizes them anyway, which cuts the image
+        # data piped from pdftoppm and handed to Tesseract to a third of RGB.
+        rendered = convert_from_bytes(
+            pdf_bytes,
+            dpi=page_dpis[run[0]],
+            first_page=run[0] + 1,
+            last_page=run[-1] + 1,
+            thread_count=OCR_RENDER_THREADS,
+            grayscale=True
+        )
+        images.update(zip(run, rendered))
 
-    # ---------- STEP 1: NORMAL TEXT EXTRACTION ----------
-    doc = fitz.open(stream=file_bytes, filetype="pdf")
-    full_text = ""
+    return images
 
-    progress_container = st.empty()
-    bar = st.progress(0)
+def _ocr_page(i, img):
+    """OCRs a single rendered page. Returns (page_index, text), with text=None on failure."""
+    try:
+        return i, pytesseract.image_to_string(img)
+    except Exception:
+        return i, None
 
-    total_pages = len(doc)
+def _ocr_page_group(indices, imgs):
+    """
+    OCRs several pages in one Tesseract run by handing it a multi-page TIFF,
+    which pays the process start-up and model load once per group.
+    Tesseract ends every page with a form feed; if the output cannot be split
+    back into one segment per page, the group falls back to per-page OCR.
+    Returns a list of (page_index, text) tuples.
+    """
+    if len(imgs) == 1:
+        return [_ocr_page(indices[0], imgs[0])]
 
-    for i, page in enumerate(doc):
-        bar.progress((i + 1) / total_pages)
-        progress_container.caption(f"📄 Extracting Text Page {i+1}/{total_pages}")
+    fd, tiff_path = tempfile.mkstemp(suffix=".tif")
+    os.close(fd)
+    try:
+        imgs[0].save(tiff_path, save_all=True, append_images=imgs[1:])
+        segments = pytesseract.image_to_string(tiff_path).split("\f")
+    except Exception:
+        segments = []
+    finally:
+        os.remove(tiff_path)
+
+    if len(segments) == len(imgs) + 1 and not segments[-1].strip():
+        segments.pop()
+    if len(segments) != len(imgs):
+        return [_ocr_page(i, img) for i, img in zip(indices, imgs)]
+    return list(zip(indices, segments))
+
+def extract_pdf_content(pdf_bytes):
+    """Extracts page text from raw PDF bytes, falling back to OCR for scanned pages."""
+
+    # A PDF extracted before (same bytes) is served from the extraction cache
+    pdf_hash = hashlib.sha256(pdf_bytes).hexdigest()
+    cached_text = db.get_cached_pdf(pdf_hash)
+    if cached_text is not None:
+        return cached_text
 
-        try:
-            text = page.get_text("text")
-            full_text += f"\n--- PAGE_BREAK ---\n{text}\n"
-        except:
-            pass
+    # ---------- STEP 1: NORMAL TEXT EXTRACTION ----------
+    layer_texts = []
+    page_rects = []
+    ocr_indices = []
 
-    progress_container.empty()
-    bar.empty()
+    progress = ThrottledProgress()
 
-    # ---------- STEP 2: QUALITY CHECK ----------
-    if len(full_text.strip()) > 500:
-        return full_text
+    # The document is closed as soon as the text layer is read, releasing
+    # MuPDF's native memory before any OCR work starts.
+    with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
+        total_pages = len(doc)
 
-    # ---------- STEP 3: OCR FALLBACK ----------
-    st.warning("⚠️ Low text detected. Switching to OCR scanning...")
+        for i, page in enumerate(doc):
+            progress.update((i + 1) / total_pages, f"📄 Extracting Text Page {i+1}/{total_pages}")
+            page_rects.append(page.rect)
 
-    images = convert_from_bytes(file_bytes)
+            try:
+                layer_texts.append(page.get_text("text"))
+            except:
+                layer_texts.append(None)
+
+            # Per-page triage: a page with little text-layer text that carries
+            # images is most likely scanned and is queued for OCR. Rich pages
+            # and blank or purely vector pages keep their text layer.
+            text = layer_texts[-1]
+            if (not text or len(text.strip()) < OCR_MIN_PAGE_TEXT_CHARS) and page.get_images():
+                ocr_indices.append(i)
+
+    # Closing the document doesn't empty MuPDF's global object store; shrink
+    # it so a long-running server doesn't hold cached resources per upload.
+    fitz.TOOLS.store_shrink(100)
+    progress.empty()
+
+    full_text = "".join(
+        f"\n--- PAGE_BREAK ---\n{text}\n" for text in layer_texts if text is not None
+    )
 
-    ocr_text = ""
-    progress_container = st.empty()
-    bar = st.progress(0)
+    # ---------- STEP 2: QUALITY CHECK ----------
+    if not ocr_indices:
+        db.cache_pdf(pdf_hash, full_text)
+        return full_text
 
-    for i, img in enumerate(images):
-        bar.progress((i + 1) / len(images))
-        progress_container.caption(f"🔍 OCR Processing Page {i+1}/{len(images)}")
+    # ---------- STEP 3: OCR FALLBACK ----------
+    if not OCR_AVAILABLE:
+        st.warning(f"⚠️ {len(ocr_indices)} page(s) look scanned, but OCR is unavailable (Tesseract/Poppler not installed). Using the PDF's text layer only.")
+        return full_text
 
-        try:
-            text = pytesseract.image_to_string(img)
-            ocr_text += f"\n--- PAGE_BREAK ---\n{text}\n"
-        except:
-            pass
+    st.warning(f"⚠️ {len(ocr_indices)} page(s) look scanned. Running OCR on them...")
+
+    # Only the triaged pages are rendered and OCR'd; every other page keeps
+    # its text layer.
+    page_texts = list(layer_texts)
+    for i in ocr_indices:
+        page_texts[i] = None
+    # Standard pages render at OCR_DPI; posters and oversized scans are
+    # capped so they don't produce huge images Tesseract gains nothing from.
+    images = _render_pages(pdf_bytes, {i: _ocr_dpi(page_rects[i]) for i in ocr_indices})
+
+    # Pages OCR'd before (same rendered pixels) are served from the page cache
+    page_hashes = {i: hashlib.blake2b(img.tobytes()).hexdigest() for i, img in images.items()}
+    for i, page_hash in page_hashes.items():
+        page_texts[i] = db.get_cached_page(page_hash)
+
+    # Repeated pages (title slides, section dividers, "Questions?" pages) are
+    # OCR'd once and their text reused. Only pages with identical rendered
+    # pixels count as repeats, so pages differing in a footer or page number
+    # are still read on their own.
+    first_seen = {}
+    duplicate_of = {}
+    for i, page_hash in page_hashes.items():
+        if page_hash in first_seen:
+            duplicate_of[i] = first_seen[page_hash]
+        else:
+            first_seen[page_hash] = i
+
+    pending = [i for i in images if page_texts[i] is None and i not in duplicate_of]
+
+    progress = ThrottledProgress()
+
+    # Tesseract runs as a subprocess, so page groups can be OCR'd concurrently.
+    # Pages are only packed together once there are more of them than workers,
+    # so short documents still get one single-threaded Tesseract per page.
+    # Results are collected by page index to keep the original page order.
+    group_size = max(1, min(OCR_PAGES_PER_CALL, math.ceil(len(pending) / OCR_MAX_WORKERS)))
+    groups = [pending[g:g + group_size] for g in range(0, len(pending), group_size)]
+    done = 0
+    with ThreadPoolExecutor(max_workers=OCR_MAX_WORKERS) as executor:
+        futures = [executor.submit(_ocr_page_group, group, [images[i] for i in group]) for group in groups]
+
+        for future in as_completed(futures):
+            for i, text in future.result():
+                page_texts[i] = text
+                if text is not None:
+                    db.cache_page(page_hashes[i], text)
+                done += 1
+            progress.update(done / len(pending), f"🔍 OCR Processing Page {done}/{len(pending)}")
+
+    # Release the rendered page bitmaps now rather than when the function returns
+    for img in images.values():
+        img.close()
+    images.clear()
+
+    for i, source in duplicate_of.items():
+        if page_texts[i] is None:
+            page_texts[i] = page_texts[source]
+
+    # Any page OCR could not read makes this a partial result: it is still
+    # returned, but not cached, so a later upload (e.g. after fixing the
+    # Tesseract install) gets a fresh attempt.
+    ocr_complete = all(page_texts[i] is not None for i in ocr_indices)
+
+    # Keep whatever text layer a page had if OCR could not read it
+    for i in ocr_indices:
+        if page_texts[i] is None:
+            page_texts[i] = layer_texts[i]
+
+    ocr_text = "".join(
+        f"\n--- PAGE_BREAK ---\n{text}\n" for text in page_texts if text is not None
+    )
 
-    progress_container.empty()
-    bar.empty()
+    progress.empty()
 
+    if ocr_complete:
+        db.cache_pdf(pdf_hash, ocr_text)
     return ocr_text
 
     
@@ -1000,7 +1544,7 @@ with st.sidebar:
     st.markdown("---")
     
     # LOAD PROJECTS FROM DATABASE
-    saved_projects = db.load_all_projects()
+    saved_projects = load_project_names(db.projects_version)
     
     if saved_projects:
         st.subheader("📁 Saved Projects")
@@ -1030,7 +1574,7 @@ if not api_key_configured:
     st.stop()
     
 try:
-    client = Groq(api_key=final_api_key)
+    client = get_groq_client(final_api_key)
 except Exception as e:
     st.error(f"❌ Error initializing Groq client. Please check your API key. Details: {e}")
     st.stop()
@@ -1044,6 +1588,13 @@ if st.session_state.current_project is None:
     uploaded_file = st.file_uploader("Upload PDF Document", type="pdf")
     
     if uploaded_file:
+        # Extract once per upload; changing the level or name below only
+        # re-runs note synthesis, not the (much slower) extraction.
+        if not uploaded_file.file_id == st.session_state.get('last_uploaded_project_pdf_id'):
+            with st.spinner("Step 1: Extracting text from PDF..."):
+                st.session_state.new_project_raw_text = extract_pdf_content(uploaded_file.getvalue())
+            st.session_state.last_uploaded_project_pdf_id = uploaded_file.file_id
+
         col1, col2 = st.columns(2)
         with col1:
             project_name = st.text_input("Project Name", value=uploaded_file.name.split('.')[0])
@@ -1052,8 +1603,7 @@ if st.session_state.current_project is None:
             
         if st.button("✨ Create & Generate Study Guide", type="primary"):
             
-            with st.spinner("Step 1: Extracting text from PDF..."):
-                raw_text = extract_pdf_content(uploaded_file)
+            raw_text = st.session_state.new_project_raw_text
             
             if len(raw_text) > 50:
                 with st.spinner("Step 2: Synthesizing notes with Groq LLM..."):
@@ -1076,7 +1626,7 @@ if st.session_state.current_project is None:
 
 # VIEW 2: PROJECT DASHBOARD
 else:
-    project_data = db.get_project_details(st.session_state.current_project)
+    project_data = load_project_details(st.session_state.current_project, db.projects_version)
     
     if project_data:
         practice_data = json.loads(project_data.get('practice_data') or "{}")
@@ -1121,8 +1671,11 @@ else:
             
             if st.button("🎯 Explain with Analogy"):
                 if topic_request:
-                    new_analogy = generate_specific_analogy(topic_request, client)
-                    db.update_analogy_data(project_data['name'], topic_request, new_analogy)
+                    # Analogies saved with the project are reused instead of regenerated
+                    new_analogy = analogy_data.get(topic_request)
+                    if not new_analogy or new_analogy.startswith("Error generating analogy"):
+                        new_analogy = generate_specific_analogy(topic_request, client)
+                        db.update_analogy_data(project_data['name'], topic_request, new_analogy)
                     st.session_state.analogy_request = topic_request
                     st.session_state.analogy_content = new_analogy
                     st.rerun()
@@ -1154,7 +1707,7 @@ else:
         
                 if not uploaded_pdf.file_id == st.session_state.get('last_uploaded_exam_pdf_id'):
                     with st.spinner("Extracting text from PDF..."):
-                        pdf_text = extract_pdf_content(uploaded_pdf)
+                        pdf_text = extract_pdf_content(uploaded_pdf.getvalue())
         
                     st.session_state.exam_analysis_pdf_content = pdf_text
                     st.session_state.last_uploaded_exam_pdf_id = uploaded_pdf.file_id
@@ -1178,42 +1731,66 @@ else:
                         st.error("Not enough text for analysis.")
                 
                     else:
+                        # Stable content key: Python's hash() is salted per process,
+                        # so the same paper used to get a new key (and a new LLM
+                        # analysis) after every restart.
+                        analysis_key = f"analysis_{hashlib.sha256(question_content.encode('utf-8')).hexdigest()}"
+
                         # --- Phase 2 Input Enhancement ---
                         enhanced_content = enhance_exam_analysis_input(question_content)
-                
-                        # --- Core Exam Analysis ---
-                        analysis_result = analyze_past_papers(
-                            paper_content=enhanced_content,
-                            client=client
-                        )
-                
+
                         # --- Phase 2.5 Intelligence ---
                         freq_topics = analyze_topic_frequency(enhanced_content)
                         weight_topics = analyze_marks_weightage(enhanced_content)
-                        predicted_qs = generate_predicted_questions(freq_topics, client)
-                
-                        analysis_result += "\n\n---\n### 📊 Topic Frequency Trends\n"
-                        analysis_result += "\n".join(
+
+                        stats_sections = "\n\n---\n### 📊 Topic Frequency Trends\n"
+                        stats_sections += "\n".join(
                             [f"- {t[0]} ({t[1]} occurrences)" for t in freq_topics]
                         )
-                
-                        analysis_result += "\n\n---\n### 🎯 High Marks Weightage Topics\n"
-                        analysis_result += "\n".join(
+
+                        stats_sections += "\n\n---\n### 🎯 High Marks Weightage Topics\n"
+                        stats_sections += "\n".join(
                             [f"- {t[0]} (Avg Marks: {t[1]:.1f})" for t in weight_topics]
                         )
-                
-                        analysis_result += "\n\n---\n### 🔮 Predicted Important Questions\n"
-                        analysis_result += predicted_qs
-                
+
+                        stats_sections += "\n\n---\n### 🔮 Predicted Important Questions\n"
+
+                        # Legacy keys can't be recomputed, so a report saved under
+                        # one is recognised by its locally computed (deterministic)
+                        # trend sections and moved to the stable key on save
+                        legacy_keys = [
+                            key for key, report in exam_analysis_data.items()
+                            if not EXAM_ANALYSIS_KEY_RE.fullmatch(key) and stats_sections in report
+                        ] if freq_topics or weight_topics else []
+
+                        stored_report = exam_analysis_data.get(analysis_key)
+                        if not stored_report and legacy_keys:
+                            stored_report = exam_analysis_data[legacy_keys[0]]
+
+                        if stored_report and not stored_report.startswith(EXAM_ANALYSIS_ERROR_PREFIX):
+                            # Previously analyzed paper: reuse the stored report, no API calls
+                            analysis_result = stored_report
+                        else:
+                            # --- Core Exam Analysis + Predictions (single LLM call) ---
+                            analysis_result, predicted_qs = analyze_past_papers_with_predictions(
+                                paper_content=enhanced_content,
+                                topics=freq_topics,
+                                client=client
+                            )
+                            analysis_result += stats_sections + predicted_qs
+
                         # --- Save Result ---
-                        current_hash = hash(question_content)
-                        analysis_key = f"analysis_{current_hash}"
-                
-                        db.update_exam_analysis_data(
-                            project_data['name'],
-                            analysis_key,
-                            analysis_result
-                        )
+                        # A failed analysis is shown but not saved, so the next click
+                        # retries it. Saving replaces any legacy copy of this paper so
+                        # the cross-paper trends count it once.
+                        if legacy_keys or analysis_result != exam_analysis_data.get(analysis_key):
+                            if not analysis_result.startswith(EXAM_ANALYSIS_ERROR_PREFIX):
+                                db.update_exam_analysis_data(
+                                    project_data['name'],
+                                    analysis_key,
+                                    analysis_result,
+                                    replaces=legacy_keys
+                                )
                 
                         # --- Update Session + Refresh ---
                         st.session_state.exam_analysis_text = analysis_result